@@ -32,9 +32,8 @@ import os
 import tables
 import sys
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from math import cos, sin
-from numpy.linalg import inv
 from pyFAI.detectors import ALL_DETECTORS
 from gi.repository import Hkl
 
@@ -44,7 +43,11 @@ from .. import backend, errors, util
 # Projections #
 ###############
 
-PDataFrame = namedtuple("PDataFrame", ["pixels", "k", "ub", "R", "P"])
+PDataFrame = namedtuple("PDataFrame", ["pixels", "kf", "k", "ub", "R", "P"])
+
+# the ki vector should be in the NexusFile or easily extracted from the
+# hkl library.
+KI = numpy.array([1, 0, 0])
 
 
 class realspace(backend.ProjectionBase):
@@ -62,8 +65,11 @@ class Pixels(backend.ProjectionBase):
     # scalars: mu, theta, [chi, phi, "omitted"] delta, gamR, gamT, ty,
     # wavelength 3x3 matrix: UB
     def project(self, index, pdataframe):
-        return numpy.meshgrid(numpy.arange(pdataframe.pixels[0].shape[1]),
-                              numpy.arange(pdataframe.pixels[0].shape[0]))
+        shape = pdataframe.pixels[0].shape
+        x = numpy.arange(shape[1])
+        y = numpy.arange(shape[0])[:, numpy.newaxis]
+        # read-only views, equivalent to numpy.meshgrid(x, y)
+        return numpy.broadcast_to(x, shape), numpy.broadcast_to(y, shape)
 
     def get_axis_labels(self):
         return 'x', 'y'
@@ -75,17 +81,10 @@ class HKLProjection(backend.ProjectionBase):
     def project(self, index, pdataframe):
         # put the detector at the right position
 
-        pixels, k, UB, R, P = pdataframe
-
-        ki = [1, 0, 0]
-        RUB_1 = inv(numpy.dot(R, UB))
-        RUB_1P = numpy.dot(RUB_1, P)
-        kf = normalized(pixels, axis=0)
-        hkl_f = numpy.tensordot(RUB_1P, kf, axes=1)
-        hkl_i = numpy.dot(RUB_1, ki)
-        hkl = hkl_f - hkl_i[:, numpy.newaxis, numpy.newaxis]
+        pixels, kf, k, UB, R, P = pdataframe
 
-        h, k, l = hkl * k
+        RUB_1 = inv3x3(numpy.dot(R, UB))
+        h, k, l = scattering_vectors(kf, k, RUB_1, P).reshape(pixels.shape)
 
         return (h, k, l)
 
@@ -106,28 +105,12 @@ class QxQyQzProjection(backend.ProjectionBase):
     def project(self, index, pdataframe):
         # put the detector at the right position
 
-        pixels, k, _, R, P = pdataframe
-
-        # TODO factorize with HklProjection. Here a trick in order to
-        # compute Qx Qy Qz in the omega basis.
-        UB = numpy.array([[2* math.pi, 0           , 0],
-                          [0         , 0           , 2* math.pi],
-                          [0         , -2 * math.pi, 0]])
-
-        UB = numpy.array([[2* math.pi, 0           , 0],
-                          [0         , 2 * math.pi , 0],
-                          [0         , 0, 2 * math.pi]])
-        # the ki vector should be in the NexusFile or easily extracted
-        # from the hkl library.
-        ki = [1, 0, 0]
-        RUB_1 = inv(numpy.dot(R, UB))
-        RUB_1P = numpy.dot(RUB_1, P)
-        kf = normalized(pixels, axis=0)
-        hkl_f = numpy.tensordot(RUB_1P, kf, axes=1)
-        hkl_i = numpy.dot(RUB_1, ki)
-        hkl = hkl_f - hkl_i[:, numpy.newaxis, numpy.newaxis]
-
-        qx, qy, qz = hkl * k
+        pixels, kf, k, _, R, P = pdataframe
+
+        # Qx Qy Qz are the hkl coordinates for UB = 2 * pi * I. As R is
+        # a rotation, (R . UB)^-1 reduces to R^T / (2 * pi).
+        RUB_1 = R.T / (2 * math.pi)
+        qx, qy, qz = scattering_vectors(kf, k, RUB_1, P).reshape(pixels.shape)
         return qx, qy, qz
 
     def get_axis_labels(self):
@@ -156,15 +139,39 @@ def get_nxclass(hfile, nxclass, path="/"):
     :type hfile: tables.file.
     :param nxclass: the nxclass to extract
     :type nxclass: str
+
+    The walk under path stops at the first match; it is kept on hfile,
+    with the first node of each nxclass met so far, for the next
+    lookups.
     """
-    for node in hfile.walk_nodes(path):
+    try:
+        walks = hfile._nx_walks
+    except AttributeError:
+        walks = hfile._nx_walks = {}
+    if path not in walks:
+        walks[path] = ({}, hfile.walk_nodes(path))
+    seen, nodes = walks[path]
+    if nxclass in seen:
+        return seen[nxclass]
+    for node in nodes:
         try:
-            if nxclass == node._v_attrs['NX_class']:
-                return node
+            value = node._v_attrs['NX_class']
         except KeyError:
+            continue
+        # array valued attributes are not hashable.
+        if isinstance(value, numpy.ndarray):
+            if value.size != 1:
+                continue
+            value = value.item()
+        try:
+            seen.setdefault(value, node)
+        except TypeError:
             pass
+        if nxclass == value:
+            return seen.setdefault(nxclass, node)
     return None
 
+
 Diffractometer = namedtuple('Diffractometer',
                             ['name',  # name of the hkl diffractometer
                              'ub',  # the UB matrix
@@ -228,12 +235,13 @@ def get_detector(hfile):
 
     return Detector("imxpads140", detector)
 
-Source = namedtuple("Source", ["wavelength"])
+Source = namedtuple("Source", ["wavelength",
+                               "k"])  # the wave number 2 * pi / wavelength
 
 
 def get_source(hfile):
     wavelength = get_nxclass(hfile, 'NXmonochromator').wavelength[0]
-    return Source(wavelength)
+    return Source(wavelength, 2 * math.pi / wavelength)
 
 
 DataFrame = namedtuple("DataFrame", ["diffractometer",
@@ -259,11 +267,55 @@ def dataframes(hfile, data_path=None):
                     child = None
                 else:
                     raise
+            # the motors positions are small 1D arrays, read them at
+            # once instead of one hdf5 access per image.
+            if key != "image" and child is not None:
+                child = child.read()
             h5_nodes[key] = child
 
         yield DataFrame(diffractometer, sample, detector, source, h5_nodes)
 
 
+_PIXELS = OrderedDict()
+_PIXELS_MAXSIZE = 8
+
+
+def detector_pixels(name, centralpixel, sdd):
+    """
+    :param name: the pyFAI name of the detector
+    :type name: str
+    :param centralpixel: the (x, y) pixel hit by the direct beam
+    :type centralpixel: (int, int)
+    :param sdd: the sample to detector distance (mm)
+    :type sdd: float
+    :return: the pixel positions in the hkl library coordinates
+    :rtype: numpy.ndarray (3, H, W), read-only
+
+    The positions of the last _PIXELS_MAXSIZE configurations are cached
+    and shared.
+    """
+    key = (name, centralpixel, sdd)
+    try:
+        # re-insert to mark the entry as the most recently used
+        pixels = _PIXELS.pop(key)
+    except KeyError:
+        detector = ALL_DETECTORS[name]()
+        y, x, _ = detector.calc_cartesian_positions()
+        y0 = y[centralpixel[1], centralpixel[0]]
+        x0 = x[centralpixel[1], centralpixel[0]]
+        z = numpy.ones(x.shape) * -1 * sdd
+        # return converted to the hkl library coordinates
+        # x -> -y
+        # y -> z
+        # z -> -x
+        pixels = numpy.array([-z, -(x - x0), (y - y0)])
+        pixels.setflags(write=False)
+        if len(_PIXELS) >= _PIXELS_MAXSIZE:
+            _PIXELS.popitem(last=False)
+    _PIXELS[key] = pixels
+    return pixels
+
+
 def get_ki(wavelength):
     """
     for now the direction is always along x
@@ -278,6 +330,68 @@ def normalized(a, axis=-1, order=2):
     return a / numpy.expand_dims(l2, axis)
 
 
+def normalized_vectors(a):
+    """
+    :param a: an array of 3D vectors stored along the first axis
+    :type a: numpy.ndarray (3, ...) of floats
+    :return: the unit vectors (null vectors are left untouched)
+    :rtype: numpy.ndarray (3, ...)
+
+    Faster equivalent of normalized(a, axis=0) for 3D vectors.
+    """
+    l2 = a[0] * a[0]
+    l2 += a[1] * a[1]
+    l2 += a[2] * a[2]
+    numpy.sqrt(l2, out=l2)
+    l2[l2 == 0] = 1
+    return a / l2
+
+
+def scattering_vectors(kf, k, RUB_1, P):
+    """
+    :param kf: the unit vectors of the diffracted beam
+    :type kf: numpy.ndarray (3, N)
+    :param k: the wave number
+    :type k: float
+    :param RUB_1: the inverse of the sample orientation matrix (RUB)^-1
+    :type RUB_1: numpy.ndarray (3, 3)
+    :param P: the detector rotation matrix
+    :type P: numpy.ndarray (3, 3)
+    :return: k * (RUB)^-1 . (P . kf - ki)
+    :rtype: numpy.ndarray (3, N)
+    """
+    # scale the 3x3 matrices rather than the images, so that only one
+    # array of the size of the detector is allocated.
+    kRUB_1 = k * RUB_1
+    q = numpy.dot(kRUB_1, P).dot(kf)
+    q -= numpy.dot(kRUB_1, KI)[:, numpy.newaxis]
+    return q
+
+
+def inv3x3(m):
+    """
+    :param m: an invertible matrix
+    :type m: numpy.ndarray (3, 3)
+    :return: the inverse of m
+    :rtype: numpy.ndarray (3, 3)
+
+    Closed form (adjugate / determinant) inverse, faster than
+    numpy.linalg.inv for a single 3x3 matrix.
+    """
+    # work on python floats, numpy scalar arithmetic would be slower
+    # than the LAPACK call.
+    (a, b, c), (d, e, f), (g, h, i) = m.tolist()
+    A = e * i - f * h
+    B = f * g - d * i
+    C = d * h - e * g
+    det = a * A + b * B + c * C
+    if det == 0:
+        raise numpy.linalg.LinAlgError('Singular matrix')
+    return numpy.array([[A, c * h - b * i, b * f - c * e],
+                        [B, a * i - c * g, c * d - a * f],
+                        [C, b * g - a * h, a * e - b * d]]) / det
+
+
 def hkl_matrix_to_numpy(m):
     M = numpy.empty((3, 3))
     for i in range(3):
@@ -351,8 +465,24 @@ class SIXS(backend.InputBase):
             try:
                 for dataframe in dataframes(scan, self.HPATH):
                     pixels = self.get_pixels(dataframe.detector)
+                    # the weights of the unattenuated images only depend
+                    # on the mask; they are shared by all the frames and
+                    # kept as 0/1 bytes (the binning promotes them).
+                    mask = self.get_mask(dataframe.detector)
+                    weights = (~mask).view(numpy.uint8)
+                    weights.setflags(write=False)
+                    # the pixels do not move during the scan, so the
+                    # kf directions can be computed once. The constant
+                    # detector rotation is applied here instead of
+                    # being multiplied into P for every image.
+                    # They are kept flattened as (3, H*W) for the
+                    # projections matrix products.
+                    kf = normalized_vectors(pixels.reshape(3, -1))
+                    if self.config.detrot is not None:
+                        detrot = M(math.radians(self.config.detrot), [1, 0, 0])
+                        kf = detrot.dot(kf)
                     for index in range(job.firstpoint, job.lastpoint + 1):
-                        yield self.process_image(index, dataframe, pixels)
+                        yield self.process_image(index, dataframe, pixels, kf, weights)
                 util.statuseol()
             except Exception as exc:
                 exc.args = errors.addmessage(exc.args, ', An error occured for scan {0} at point {1}. See above for more information'.format(self.dbg_scanno, self.dbg_pointno))
@@ -459,13 +589,8 @@ class FlyScanUHV(SIXS):
 
         return (image, attenuation, (mu, omega, delta, gamma))
 
-    def process_image(self, index, dataframe, pixels):
+    def process_image(self, index, dataframe, pixels, kf, mask_weights):
         util.status(str(index))
-        detector = ALL_DETECTORS[dataframe.detector.name]()
-        mask = detector.mask.astype(numpy.bool)
-        maskmatrix = load_matrix(self.config.maskmatrix)
-        if maskmatrix is not None:
-            mask = numpy.bitwise_or(mask, maskmatrix)
 
         # extract the data from the h5 nodes
 
@@ -482,15 +607,11 @@ class FlyScanUHV(SIXS):
         if self.config.attenuation_coefficient is not None:
             if attenuation != WRONG_ATTENUATION:
                 intensity *= self.config.attenuation_coefficient ** attenuation
-                weights = numpy.ones_like(intensity)
-                weights *= ~mask
+                weights = mask_weights
             else:
-                weights = numpy.zeros_like(intensity)
+                weights = numpy.zeros_like(mask_weights)
         else:
-            weights = numpy.ones_like(intensity)
-            weights *= ~mask
-
-        k = 2 * math.pi / dataframe.source.wavelength
+            weights = mask_weights
 
         hkl_geometry = dataframe.diffractometer.geometry
         hkl_geometry.axis_values_set(values, Hkl.UnitEnum.USER)
@@ -505,26 +626,25 @@ class FlyScanUHV(SIXS):
         q_detector = hkl_geometry.detector_rotation_get(hkl_detector)
         P = hkl_matrix_to_numpy(q_detector.to_matrix())
 
-        if self.config.detrot is not None:
-            P = numpy.dot(P, M(math.radians(self.config.detrot), [1, 0, 0]))
-
-        pdataframe = PDataFrame(pixels, k, dataframe.diffractometer.ub, R, P)
+        pdataframe = PDataFrame(pixels, kf, dataframe.source.k,
+                                dataframe.diffractometer.ub, R, P)
 
         # util.status('{4}| gamma: {0}, delta: {1}, theta: {2}, mu: {3}'.format(gamma, delta, theta, mu, time.ctime(time.time())))
 
         return intensity, weights, (index, pdataframe)
 
-    def get_pixels(self, detector):
+    def get_mask(self, detector):
         detector = ALL_DETECTORS[detector.name]()
-        y, x, _ = detector.calc_cartesian_positions()
-        y0 = y[self.config.centralpixel[1], self.config.centralpixel[0]]
-        x0 = x[self.config.centralpixel[1], self.config.centralpixel[0]]
-        z = numpy.ones(x.shape) * -1 * self.config.sdd
-        # return converted to the hkl library coordinates
-        # x -> -y
-        # y -> z
-        # z -> -x
-        return numpy.array([-z, -(x - x0), (y - y0)])
+        mask = detector.mask.astype(bool)
+        maskmatrix = load_matrix(self.config.maskmatrix)
+        if maskmatrix is not None:
+            mask = numpy.bitwise_or(mask, maskmatrix)
+        return mask
+
+    def get_pixels(self, detector):
+        return detector_pixels(detector.name,
+                               tuple(self.config.centralpixel),
+                               self.config.sdd)
 
 
 class FlyScanUHV2(FlyScanUHV):
@@ -550,7 +670,7 @@ class FlyMedH(FlyScanUHV):
 
     def get_values(self, index, h5_nodes):
         image = h5_nodes['image'][index]
-        pitch = h5_nodes['pitch'][index] if h5_nodes['pitch'] else 0.3
+        pitch = h5_nodes['pitch'][index] if h5_nodes['pitch'] is not None else 0.3
         mu = h5_nodes['mu'][index]
         gamma = h5_nodes['gamma'][index]
         delta = h5_nodes['delta'][index]
@@ -599,12 +719,12 @@ class FlyMedV(FlyScanUHV):
 
     def get_values(self, index, h5_nodes):
         image = h5_nodes['image'][index]
-        beta = h5_nodes['beta'][index] if h5_nodes['beta'] else 0.0
+        beta = h5_nodes['beta'][index] if h5_nodes['beta'] is not None else 0.0
         mu = h5_nodes['mu'][index]
         omega = h5_nodes['omega'][index]
         gamma = h5_nodes['gamma'][index]
         delta = h5_nodes['delta'][index]
-        etaa = h5_nodes['etaa'][index] if h5_nodes['etaa'] else 0.0
+        etaa = h5_nodes['etaa'][index] if h5_nodes['etaa'] is not None else 0.0
         attenuation = self.get_attenuation(index, h5_nodes, 2)
 
         return (image, attenuation, (beta, mu, omega, gamma, delta, etaa))
@@ -616,9 +736,9 @@ def load_matrix(filename):
     if os.path.exists(filename):
         ext = os.path.splitext(filename)[-1]
         if ext == '.txt':
-            return numpy.array(numpy.loadtxt(filename), dtype=numpy.bool)
+            return numpy.loadtxt(filename).astype(bool)
         elif ext == '.npy':
-            return numpy.array(numpy.load(filename), dtype=numpy.bool)
+            return numpy.load(filename).astype(bool, copy=False)
         else:
             raise ValueError('unknown extension {0}, unable to load matrix!\n'.format(ext))
     else: